@@ -1,9 +1,7 @@
 """Bring Your Own Environment"""
 
 import sys, os, logging, re
-from dataclasses import dataclass, asdict
 from io import TextIOWrapper
-from copy import deepcopy
 from pathlib import Path
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple, Union
@@ -24,6 +22,7 @@ from .globals import (
     ShellType,
     SnapId,
     SnapSpec,
+    SafeLoader,
 )
 from .util import (
     get_closest_snap,
@@ -32,7 +31,13 @@ from .util import (
     get_env_cmd,
     get_activated_envrion,
 )
-from .conf import CondaAppConfig, PythonAppConfig, SiteConfig, IncludableConfig
+from .conf import (
+    CondaAppConfig,
+    PythonAppConfig,
+    SiteConfig,
+    IncludableConfig,
+    get_site_conf,
+)
 from .spack import (
     get_spack_install,
     get_spack_pkg_cmds,
@@ -81,8 +86,8 @@ class ByoeRepo:
                 self._site_conf = SiteConfig()
             site_conf_path.write_text(yaml.dump(self._site_conf.to_dict()))
         else:
-            self._site_conf = SiteConfig.from_dict(
-                yaml.safe_load(site_conf_path.read_text())
+            self._site_conf = get_site_conf(
+                site_conf_path, base_dir / "._internal" / "site_conf.json"
             )
         if self._site_conf.defaults is not None:
             if self._site_conf.envs:
@@ -351,8 +356,9 @@ class ByoeRepo:
                 compiler = config.build_chain.compiler
                 if compiler:
                     spec = f"{spec} %{compiler}"
+            # Loading fails if the spec isn't installed, so no need for 'spack find'
             try:
-                spack.find(spec)
+                mamba_act_text = spack.load("--sh", spec)
             except sh.ErrorReturnCode:
                 spack_install = get_spack_install(
                     spack, self._locs["tmp"], build_config=self._site_conf.build_opts
@@ -367,7 +373,7 @@ class ByoeRepo:
                         "site",
                     )
                 spack_install([spec])
-            mamba_act_text = spack.load("--sh", spec)
+                mamba_act_text = spack.load("--sh", spec)
         elif config.source.startswith("https://"):
             bin_dir = self._locs["conda"] / "bin"
             if not (bin_dir / "micromamba").exists():
@@ -533,12 +539,24 @@ class ByoeRepo:
             base_path = self._locs["apps"]
         for env_type in EnvType:
             name_dir = base_path / env_type.value / name
-            if not name_dir.exists():
+            lock_suffix = LOCK_SUFFIXES[env_type]
+            # One directory listing gives us both the lock files and the snap dirs
+            lock_files = []
+            snap_dirs = set()
+            try:
+                with os.scandir(name_dir) as entries:
+                    for entry in entries:
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.name.endswith(lock_suffix):
+                            lock_files.append(name_dir / entry.name)
+                        elif exists_only and entry.is_dir():
+                            snap_dirs.add(entry.name)
+            except FileNotFoundError:
                 continue
-            lock_files = list(name_dir.glob(f"*{LOCK_SUFFIXES[env_type]}"))
             snap_specs = [SnapSpec.from_lock_path(f) for f in lock_files]
             if exists_only:
-                snap_specs = [s for s in snap_specs if s.snap_dir.exists()]
+                snap_specs = [s for s in snap_specs if s.snap_dir.name in snap_dirs]
             snaps += snap_specs
         snaps.sort()
         res = []
@@ -578,10 +596,15 @@ class ByoeRepo:
             else:
                 raise ValueError(f"Current shell is unsupported: {curr_shell}")
         # Determine which top-level SnapId we are using
-        avail = [
-            SnapId.from_prefix(x.name)
-            for x in self._locs["envs"].glob("*-site_conf.yaml")
-        ]
+        try:
+            with os.scandir(self._locs["envs"]) as entries:
+                avail = [
+                    SnapId.from_prefix(e.name)
+                    for e in entries
+                    if e.name.endswith("-site_conf.yaml")
+                ]
+        except FileNotFoundError:
+            avail = []
         avail = [x for x in avail if x is not None]
         if not avail:
             raise ValueError(f"No snapshots available")
@@ -591,8 +614,9 @@ class ByoeRepo:
         elif snap_id not in avail:
             raise ValueError(f"No such snap: {snap_id}")
         # Load up the config from this snap, determine which apps to activate
-        snap_conf = yaml.safe_load(
-            (self._locs["envs"] / f"{snap_id}-site_conf.yaml").read_text()
+        snap_conf = yaml.load(
+            (self._locs["envs"] / f"{snap_id}-site_conf.yaml").read_bytes(),
+            Loader=SafeLoader,
         )
         if env_name is None:
             env_name = os.environ.get("BYOE_DEFAULT_ENV_NAME", "main")
@@ -678,21 +702,28 @@ class ByoeRepo:
         if time_stamp is None:
             time_stamp = datetime.now()
         min_vers = 0
-        for snap_conf in self._locs["envs"].glob(
-            f"{time_stamp.strftime(TS_FORMAT)}*-site_conf.yaml"
-        ):
-            snap_id = SnapId.from_prefix(snap_conf.stem)
-            if snap_id is None:
-                log.warning("Skipping potential snap config: %s", snap_conf)
-                continue
-            log.debug("Found existing snap: %s", snap_id)
-            if min_vers <= snap_id.version:
-                min_vers = snap_id.version + 1
-        for in_prog in self._locs["envs"].glob(
-            f".in-progress-{time_stamp.strftime(TS_FORMAT)}*"
-        ):
-            snap_id = SnapId.from_prefix(snap_conf.name.split("-")[-1])
-            if not snap_id:
+        ts_prefix = time_stamp.strftime(TS_FORMAT)
+        in_prog_prefix = f".in-progress-{ts_prefix}"
+        # Scan for existing and in-progress snaps in a single pass
+        try:
+            with os.scandir(self._locs["envs"]) as entries:
+                dir_entries = list(entries)
+        except FileNotFoundError:
+            dir_entries = []
+        for entry in dir_entries:
+            if entry.name.startswith(ts_prefix) and entry.name.endswith(
+                "-site_conf.yaml"
+            ):
+                snap_id = SnapId.from_prefix(entry.name)
+                if snap_id is None:
+                    log.warning("Skipping potential snap config: %s", entry.path)
+                    continue
+                log.debug("Found existing snap: %s", snap_id)
+            elif entry.name.startswith(in_prog_prefix):
+                snap_id = SnapId.from_prefix(entry.name[len(".in-progress-") :])
+                if snap_id is None:
+                    continue
+            else:
                 continue
             if min_vers <= snap_id.version:
                 min_vers = snap_id.version + 1
@@ -1,4 +1,4 @@
-import os, sys, logging
+import os, sys, json, logging
 from tempfile import NamedTemporaryFile
 from pathlib import Path
 from datetime import datetime
@@ -70,7 +70,11 @@ def main(
         if sys.stdout.isatty():
             conf_data["user"] = UserConfig.build_interactive()
             conf_path.parent.mkdir(exist_ok=True)
-            conf_path.write_text(yaml.dump(conf_data["user"].to_dict()))
+            user_data = conf_data["user"].to_dict()
+            if conf_path.suffix == ".json":
+                conf_path.write_text(json.dumps(user_data, indent=2))
+            else:
+                conf_path.write_text(yaml.dump(user_data))
         else:
             error_console.write("No user config at: {conf_path}")
 
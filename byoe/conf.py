@@ -1,17 +1,30 @@
-import re
-import os, logging, typing
+import re, json, hashlib
+import os, sys, logging, posixpath
 from pathlib import Path
 from enum import Enum
-from copy import deepcopy
-from dataclasses import asdict, dataclass, field, fields
+from dataclasses import Field, dataclass, field, fields, replace
 from urllib.parse import urlparse
-from urllib.request import urlopen
-from typing import ClassVar, Dict, List, Optional, Union, Any
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+    get_args,
+    get_origin,
+    get_type_hints,
+)
 
 import yaml
-import click
 
-from .globals import UpdateChannel, CHANNEL_UPDATE_MONTHS
+from .globals import UpdateChannel, CHANNEL_UPDATE_MONTHS, SafeLoader
 from .util import HAS_SLURM
 
 
@@ -21,6 +34,31 @@ log = logging.getLogger(__name__)
 DEFAULT_SLURM_TASKS = 16
 
 
+MAX_INCLUDE_FETCHES = 8
+
+
+# Map update frequency, as entered by the user, to the channel
+_FREQ_TO_CHANNEL = {str(v): k for k, v in CHANNEL_UPDATE_MONTHS.items()}
+
+
+VALID_ENV_APP_NAME = re.compile("[a-zA-Z0-9_]+")
+
+
+INCLUDE_CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser()
+    / "byoe"
+    / "includes"
+)
+
+
+# Only strings shorter than this are interned in `Config.from_dict`
+MAX_INTERN_LEN = 64
+
+
+# Avoid per-instance `__dict__` on config classes where supported
+_DATACLASS_OPTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
 class ConfigError(Exception):
     pass
 
@@ -33,114 +71,435 @@ class InvalidConfigError(ConfigError):
     pass
 
 
-def _get_conf_content(base_dir: Path, source: str) -> str:
-    """Get text from config file that could be local path or URL"""
+class IncludeLoopError(InvalidConfigError):
+    pass
+
+
+@lru_cache(maxsize=None)
+def _http_session() -> "requests.Session":
+    """Get shared HTTP session, so connections are reused across includes"""
+    # Imported lazily as it is only needed for remote includes
+    import requests
+
+    return requests.Session()
+
+
+@lru_cache(maxsize=256)
+def _fetch_url(source: str) -> bytes:
+    """Fetch content from a URL, revalidating any copy in `INCLUDE_CACHE_DIR`"""
+    cache_path = INCLUDE_CACHE_DIR / hashlib.sha256(source.encode()).hexdigest()
+    etag_path = cache_path.with_suffix(".etag")
+    headers = {}
+    try:
+        cached = cache_path.read_bytes()
+        headers["If-None-Match"] = etag_path.read_text()
+    except OSError:
+        cached = None
+    resp = _http_session().get(source, headers=headers)
+    if resp.status_code == 304 and cached is not None:
+        return cached
+    resp.raise_for_status()
+    data = resp.content
+    etag = resp.headers.get("ETag")
+    if etag:
+        try:
+            INCLUDE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            cache_path.write_bytes(data)
+            etag_path.write_text(etag)
+        except OSError:
+            log.debug("Unable to cache content from: %s", source)
+    return data
+
+
+def _get_local_path(base_dir: Path, source: str) -> Optional[Path]:
+    """Get the path for a local config `source`, or None if it is a URL"""
     url = urlparse(source)
-    if url.scheme in ("", "file"):
-        url_path = Path(url.path)
-        if not url_path.absolute:
-            url_path = base_dir / url_path
-        return url_path.read_text()
-    else:
-        return urlopen(source).read()
+    if url.scheme not in ("", "file"):
+        return None
+    url_path = Path(url.path)
+    if not url_path.is_absolute():
+        url_path = base_dir / url_path
+    return url_path
+
+
+def _get_conf_content(base_dir: Path, source: str) -> bytes:
+    """Get raw content from config file that could be local path or URL"""
+    url_path = _get_local_path(base_dir, source)
+    if url_path is None:
+        return _fetch_url(source)
+    return url_path.read_bytes()
+
+
+def _get_include_key(base_dir: Path, source: str) -> str:
+    """Get a normalized identifier for the include `source`
+
+    Different spellings of the same file (or URL) give the same key.
+    """
+    url_path = _get_local_path(base_dir, source)
+    if url_path is not None:
+        return str(url_path.resolve())
+    url = urlparse(source)
+    return url._replace(
+        scheme=url.scheme.lower(),
+        netloc=url.netloc.lower(),
+        path=posixpath.normpath(url.path) if url.path else "",
+        fragment="",
+    ).geturl()
 
 
-def _update_nested(base_dict, key, value):
-    if key not in base_dict:
-        base_dict[key] = value
-        return
-    def_val = base_dict.get(key)
-    if isinstance(value, list) and isinstance(def_val, list):
-        base_dict[key] += value
-    elif isinstance(value, dict) and isinstance(def_val, dict):
-        for k, v in value.items():
-            _update_nested(def_val, k, v)
+# Parsed include data keyed on (path, mtime_ns) for files or (url, 0) for URLs,
+# using the normalized path / url from `_get_include_key`
+_INCLUDE_CACHE: Dict[Tuple[str, int], Any] = {}
+
+
+def _load_include(base_dir: Path, source: str, incl_key: str) -> Any:
+    """Get (and cache) the parsed data for an include, which must not be modified"""
+    if _get_local_path(base_dir, source) is None:
+        key = (incl_key, 0)
     else:
-        base_dict[key] = value
+        key = (incl_key, os.stat(incl_key).st_mtime_ns)
+    try:
+        return _INCLUDE_CACHE[key]
+    except KeyError:
+        pass
+    data = yaml.load(_get_conf_content(base_dir, source), Loader=SafeLoader)
+    _INCLUDE_CACHE[key] = data
+    return data
+
+
+def _prefetch_conf_content(base_dir: Path, sources: List[str]) -> None:
+    """Concurrently fetch any remote `sources` into the `_fetch_url` cache"""
+    urls = [src for src in sources if _get_local_path(base_dir, src) is None]
+    if len(urls) < 2:
+        return
+    with ThreadPoolExecutor(max_workers=min(len(urls), MAX_INCLUDE_FETCHES)) as pool:
+        list(pool.map(_fetch_url, urls))
+
+
+def _load_yaml_cached(conf_path: Path, cache_path: Optional[Path] = None) -> Any:
+    """Load YAML data from `conf_path`, using a JSON cache at `cache_path` if given
+
+    The cache is only valid for the exact mtime and size of `conf_path`, and is only
+    written if the data survives a round trip through JSON unchanged. Failing to write
+    the cache is not an error.
+    """
+    conf_stat = conf_path.stat()
+    # Include the size, as coarse mtimes (e.g. on NFS) can miss quick edits
+    conf_key = [conf_stat.st_mtime_ns, conf_stat.st_size]
+    if cache_path is not None:
+        try:
+            cache_data = json.loads(cache_path.read_bytes())
+        except (OSError, ValueError):
+            pass
+        else:
+            if cache_data.get("key") == conf_key:
+                return cache_data["data"]
+    data = yaml.load(conf_path.read_bytes(), Loader=SafeLoader)
+    if cache_path is not None and os.access(cache_path.parent, os.W_OK):
+        try:
+            cache_text = json.dumps({"key": conf_key, "data": data})
+        except (TypeError, ValueError):
+            log.debug("Config can't be cached as JSON: %s", conf_path)
+        else:
+            if json.loads(cache_text)["data"] == data:
+                tmp_path = cache_path.parent / f".{cache_path.name}.{os.getpid()}"
+                try:
+                    tmp_path.write_text(cache_text)
+                    os.replace(tmp_path, cache_path)
+                except OSError:
+                    log.debug("Unable to write config cache: %s", cache_path)
+                    try:
+                        tmp_path.unlink()
+                    except OSError:
+                        pass
+    return data
+
+
+def _update_nested(base_dict: Dict[str, Any], update: Dict[str, Any]) -> None:
+    """Merge `update` into `base_dict`, extending nested lists and merging nested dicts
+
+    Uses an explicit stack rather than recursion, and only visits overlapping keys
+    in Python. Nested containers are copied before being modified since they can be
+    shared with the defaults.
+    """
+    stack = [(base_dict, update)]
+    while stack:
+        dest, src = stack.pop()
+        overlap = dest.keys() & src.keys()
+        if not overlap:
+            dest.update(src)
+            continue
+        if len(overlap) < len(src):
+            dest.update({k: v for k, v in src.items() if k not in overlap})
+        for key in overlap:
+            value = src[key]
+            def_val = dest[key]
+            if isinstance(value, list) and isinstance(def_val, list):
+                dest[key] = def_val + value
+            elif isinstance(value, dict) and isinstance(def_val, dict):
+                def_val = dest[key] = def_val.copy()
+                stack.append((def_val, value))
+            else:
+                dest[key] = value
+
+
+@lru_cache(maxsize=None)
+def _fields(cls: type) -> Tuple[Field, ...]:
+    """Cached version of `dataclasses.fields`"""
+    return fields(cls)
+
+
+@lru_cache(maxsize=None)
+def _field_defaults(cls: type) -> Dict[str, Any]:
+    return {f.name: f.default for f in _fields(cls)}
+
+
+def _shallow_dict(dc: Any) -> Dict[str, Any]:
+    """Like `dataclasses.asdict` but without recursing into / copying the values"""
+    return {f.name: getattr(dc, f.name) for f in _fields(type(dc))}
+
+
+def _get_tgt_class(hint: Any) -> type:
+    """Get the class we want to convert to for the given type hint"""
+    origin = get_origin(hint)
+    if origin is Union:
+        hint = next(h for h in get_args(hint) if h is not type(None))
+        origin = get_origin(hint)
+    return hint if origin is None else origin
+
+
+@lru_cache(maxsize=None)
+def _field_tgt_classes(cls: type) -> Dict[str, Any]:
+    """Get (and cache) the target class for each field of the dataclass `cls`"""
+    res = {}
+    hints = None
+    for f in _fields(cls):
+        hint = f.type
+        # Only need to evaluate the hints if there are string annotations
+        if isinstance(hint, str):
+            if hints is None:
+                hints = get_type_hints(cls)
+            hint = hints[f.name]
+        res[f.name] = _get_tgt_class(hint)
+    return res
+
+
+def _path_to_dict(val: Path) -> str:
+    return str(val)
+
+
+def _enum_to_dict(val: Enum) -> Any:
+    return val.value
+
+
+def _config_to_dict(val: "Config") -> Dict[str, Any]:
+    return val.to_dict()
+
+
+def _config_list_to_dict(val: List["Config"]) -> List[Dict[str, Any]]:
+    return [v.to_dict() for v in val]
+
+
+def _config_map_to_dict(val: Dict[str, "Config"]) -> Dict[str, Dict[str, Any]]:
+    return {k: v.to_dict() for k, v in val.items()}
+
+
+def _passthrough(val: Any) -> Any:
+    return val
+
+
+@lru_cache(maxsize=None)
+def _enum_members(enum_class: Type[Enum]) -> Dict[Any, Enum]:
+    return {m.value: m for m in enum_class}
+
+
+def _enum_from_dict(tgt_class: Type[Enum], val: Any) -> Enum:
+    val = val.lower()
+    try:
+        return _enum_members(tgt_class)[val]
+    except KeyError:
+        return tgt_class(val)
+
+
+def _coerce(tgt_class: type, val: Any) -> Any:
+    if isinstance(val, tgt_class):
+        return val
+    return tgt_class(val)
+
+
+def _config_list_from_dict(
+    conf_class: Type["Config"], val: List[Dict[str, Any]]
+) -> List["Config"]:
+    return [conf_class.from_dict(x) for x in val]
+
+
+def _config_map_from_dict(
+    conf_class: Type["Config"], val: Dict[str, Dict[str, Any]]
+) -> Dict[str, "Config"]:
+    return {k: conf_class.from_dict(v) for k, v in val.items()}
+
+
+def _intern_str(val: str) -> str:
+    if len(val) < MAX_INTERN_LEN:
+        return sys.intern(val)
+    return val
+
+
+def _intern_strs(val: List[Any]) -> List[Any]:
+    return [_intern_str(x) if type(x) is str else x for x in val]
+
+
+def _default_to_dict(tgt_class: Optional[type]) -> Callable[[Any], Any]:
+    """Get the `to_dict` handler for fields with the given target class"""
+    if tgt_class is None:
+        return _passthrough
+    if issubclass(tgt_class, Path):
+        return _path_to_dict
+    if issubclass(tgt_class, Enum):
+        return _enum_to_dict
+    if issubclass(tgt_class, Config):
+        return _config_to_dict
+    return _passthrough
+
+
+def _default_from_dict(tgt_class: Optional[type]) -> Optional[Callable[[Any], Any]]:
+    """Get the `from_dict` converter for fields with the given target class"""
+    if tgt_class is None:
+        return None
+    if issubclass(tgt_class, Config):
+        return tgt_class.from_dict
+    if issubclass(tgt_class, Enum):
+        return partial(_enum_from_dict, tgt_class)
+    return partial(_coerce, tgt_class)
+
+
+@dataclass(frozen=True, **_DATACLASS_OPTS)
+class _FieldSpec:
+    """Precomputed handling of a single config field"""
+
+    tgt_class: Optional[type]
+
+    to_dict: Callable[[Any], Any]
+
+    from_dict: Optional[Callable[[Any], Any]]
+
+    default: Any
+
+    # Bit used to track the field in `Config._explicit_mask`
+    bit: int
+
+    intern: Optional[Callable[[Any], Any]] = None
 
 
 @dataclass
 class Config:
     """Base for specifying config as dataclass"""
 
+    __slots__ = ("_explicit_mask",)
+
+    # Per-field handlers that override the ones derived from the type hints
+    _TO_DICT_HANDLERS: ClassVar[Dict[str, Callable[[Any], Any]]] = {}
+
+    _FROM_DICT_HANDLERS: ClassVar[Dict[str, Callable[[Any], Any]]] = {}
+
+    @classmethod
+    def _field_specs(cls) -> Dict[str, _FieldSpec]:
+        """Get (and cache) the `_FieldSpec` for each field, keyed by name"""
+        specs = cls.__dict__.get("_FIELD_SPECS")
+        if specs is None:
+            tgt_classes = _field_tgt_classes(cls)
+            specs = {}
+            for idx, field in enumerate(_fields(cls)):
+                tgt_class = tgt_classes[field.name]
+                if not isinstance(tgt_class, type):
+                    tgt_class = None
+                to_dict = cls._TO_DICT_HANDLERS.get(field.name)
+                if to_dict is None:
+                    to_dict = _default_to_dict(tgt_class)
+                from_dict = cls._FROM_DICT_HANDLERS.get(field.name)
+                intern = None
+                if from_dict is None:
+                    from_dict = _default_from_dict(tgt_class)
+                    # Share repeated strings (e.g. specs) between configs
+                    if tgt_class is str:
+                        intern = _intern_str
+                    elif tgt_class is list:
+                        intern = _intern_strs
+                else:
+                    # Custom converters are always called on non-None values
+                    tgt_class = None
+                specs[field.name] = _FieldSpec(
+                    tgt_class, to_dict, from_dict, field.default, 1 << idx, intern
+                )
+            cls._FIELD_SPECS = specs
+        return specs
+
     def to_dict(self) -> Dict[str, Any]:
         res = {}
-        for field in fields(self):
-            attr = field.name
+        for attr, spec in self._field_specs().items():
             val = getattr(self, attr)
-            if val is None:
-                continue
-            if isinstance(val, Path):
-                res[attr] = str(val)
-            elif isinstance(val, Enum):
-                res[attr] = val.value
-            elif isinstance(val, Config):
-                res[attr] = val.to_dict()
-            else:
-                res[attr] = val
+            if val is not None:
+                res[attr] = spec.to_dict(val)
         return res
 
     def set_defaults(self, def_config: Dict[str, Any]) -> None:
-        for field in fields(self):
-            if field.name not in def_config:
+        # Fields set explicitly in `from_dict`, or None if not tracked
+        explicit = getattr(self, "_explicit_mask", None)
+        for attr, spec in self._field_specs().items():
+            if attr not in def_config:
                 continue
-            new_def_val = def_config[field.name]
-            if (
-                not hasattr(self, "_explicitly_set")
-                or field.name not in self._explicitly_set
-            ):
-                setattr(self, field.name, new_def_val)
-            elif new_def_val != field.default:
-                prev_val = getattr(self, field.name)
+            new_def_val = def_config[attr]
+            if explicit is None or not explicit & spec.bit:
+                setattr(self, attr, new_def_val)
+            elif new_def_val != spec.default:
+                prev_val = getattr(self, attr)
                 if isinstance(new_def_val, list):
-                    if prev_val is None:
-                        prev_val = []
-                    setattr(self, field.name, prev_val + new_def_val)
+                    if not prev_val:
+                        setattr(self, attr, new_def_val[:])
+                    else:
+                        setattr(self, attr, prev_val + new_def_val)
                 elif isinstance(new_def_val, dict):
-                    if prev_val is None:
-                        prev_val = {}
                     res = new_def_val.copy()
-                    for k, v in prev_val.items():
-                        _update_nested(res, k, v)
-                    setattr(self, field.name, res)
+                    if prev_val:
+                        _update_nested(res, prev_val)
+                    setattr(self, attr, res)
+
+    def clone(self):
+        """Get a shallow copy, tracking the same explicitly set values"""
+        res = replace(self)
+        if hasattr(self, "_explicit_mask"):
+            res._explicit_mask = self._explicit_mask
+        return res
 
     @classmethod
     def get_defaults(cls):
         """Get the default values for the dataclass"""
-        return {f.name: f.default for f in fields(cls)}
+        return _field_defaults(cls).copy()
 
     @classmethod
     def from_dict(cls, conf_data: Dict[str, Any]):
-        for attr, hint in typing.get_type_hints(cls).items():
-            if attr in conf_data:
-                tgt_class = None
-                if hasattr(hint, "__origin__"):
-                    if hint.__origin__ is typing.Union:
-                        for sub_hint in typing.get_args(hint):
-                            if not sub_hint is type(None):
-                                if hasattr(sub_hint, "__origin__"):
-                                    tgt_class = sub_hint.__origin__
-                                else:
-                                    tgt_class = sub_hint
-                                break
-                    else:
-                        tgt_class = hint.__origin__
-                else:
-                    tgt_class = hint
-                if issubclass(tgt_class, Config):
-                    conf_data[attr] = tgt_class.from_dict(conf_data[attr])
-                elif issubclass(tgt_class, Enum):
-                    conf_data[attr] = tgt_class(conf_data[attr].lower())
-                elif conf_data[attr] is not None and not isinstance(
-                    conf_data[attr], tgt_class
-                ):
-                    conf_data[attr] = tgt_class(conf_data[attr])
-        res = cls(**conf_data)
-        res._explicitly_set = set(conf_data.keys())
+        specs = cls._field_specs()
+        kwargs = {}
+        explicit = 0
+        for attr, val in conf_data.items():
+            try:
+                spec = specs[attr]
+            except KeyError:
+                raise InvalidConfigError(f"Unknown option for {cls.__name__}: {attr}")
+            converter = spec.from_dict
+            # Values loaded from YAML / JSON usually already have the correct type
+            if not (converter is None or val is None or type(val) is spec.tgt_class):
+                val = converter(val)
+            if spec.intern is not None and val is not None:
+                val = spec.intern(val)
+            kwargs[attr] = val
+            explicit |= spec.bit
+        res = cls(**kwargs)
+        res._explicit_mask = explicit
         return res
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class UserConfig(Config):
     """User specific configuration"""
 
@@ -154,6 +513,8 @@ class UserConfig(Config):
 
     @classmethod
     def build_interactive(cls):
+        import click
+
         defaults = cls.get_defaults()
         base_dir = click.prompt(
             "Enter the path to the base directory for the repository",
@@ -162,14 +523,22 @@ class UserConfig(Config):
         ).expanduser()
         update_freq = click.prompt(
             "Choose your default environment update frequency in months",
-            type=click.Choice(CHANNEL_UPDATE_MONTHS.values()),
-            default=CHANNEL_UPDATE_MONTHS[defaults["channel"]],
+            type=click.Choice(list(_FREQ_TO_CHANNEL)),
+            default=str(CHANNEL_UPDATE_MONTHS[defaults["channel"]]),
         )
-        def_channel = None
-        for chan, freq in CHANNEL_UPDATE_MONTHS.items():
-            if freq == update_freq:
-                def_channel = chan
-        return cls(base_dir, def_channel)
+        return cls(base_dir, _FREQ_TO_CHANNEL[update_freq])
+
+
+def _parse_user_conf(conf_path: Path, conf_bytes: bytes) -> Any:
+    """Parse user config data, using the faster JSON parser when possible"""
+    if conf_path.suffix == ".json" or conf_bytes.lstrip()[:1] == b"{":
+        try:
+            return json.loads(conf_bytes)
+        except ValueError:
+            # YAML flow mappings are not always valid JSON
+            if conf_path.suffix == ".json":
+                raise
+    return yaml.load(conf_bytes, Loader=SafeLoader)
 
 
 def get_user_conf(conf_path: Path) -> UserConfig:
@@ -177,17 +546,17 @@ def get_user_conf(conf_path: Path) -> UserConfig:
     if not conf_path.exists():
         raise MissingConfigError(f"No such file: {conf_path}")
     try:
-        in_f = conf_path.open("rt")
+        conf_bytes = conf_path.read_bytes()
     except:
         raise InvalidConfigError(f"Unable to open config file: {conf_path}")
     try:
-        user_conf = UserConfig.from_dict(yaml.safe_load(in_f))
+        user_conf = UserConfig.from_dict(_parse_user_conf(conf_path, conf_bytes))
     except:
         raise InvalidConfigError(f"Error reading config file: {conf_path}")
     return user_conf
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class IncludableConfig(Config):
     """Base class for config that can have include statements
 
@@ -197,52 +566,54 @@ class IncludableConfig(Config):
 
     @classmethod
     def filt_include(cls, include_data):
-        """Subclasses can override this method to modify / filter included data"""
+        """Subclasses can override this method to filter included data
+
+        The `include_data` may be shared and must not be modified in place.
+        """
         return include_data
 
-    # TODO: Need support for recursive includes with loop detection here
     @classmethod
-    def from_dict(cls, conf_data: Dict[str, Any]):
-        # Handle top level includes
-        includes = conf_data.get("include")
-        if includes:
+    def _resolve_includes(
+        cls, conf_data: Dict[str, Any], stack: frozenset = frozenset()
+    ) -> Dict[str, Any]:
+        """Merge in included data, recursively resolving any nested includes
+
+        The `conf_data` must have an "include" key. The `stack` holds the normalized
+        keys of the includes currently being resolved, so the same file can be included
+        through multiple paths but not from within itself.
+        """
+        includes = conf_data["include"] or ()
+        _prefetch_conf_content(cls.base_dir, includes)
+        include_data = None
+        for include in includes:
+            incl_key = _get_include_key(cls.base_dir, include)
+            if incl_key in stack:
+                raise IncludeLoopError(f"Include loop detected for: {include}")
+            incl_conf = _load_include(cls.base_dir, include, incl_key)
+            if not isinstance(incl_conf, dict):
+                raise InvalidConfigError(f"Included config is not a mapping: {include}")
+            if "include" in incl_conf:
+                incl_conf = cls._resolve_includes(incl_conf, stack | {incl_key})
+            incl_conf = cls.filt_include(incl_conf)
+            # Loaded includes are cached and shared, so only the copy is updated
+            if include_data is None:
+                include_data = incl_conf.copy()
+            else:
+                include_data.update(incl_conf)
+        if include_data is None:
             include_data = {}
-            for include in includes:
-                include_data.update(
-                    cls.filt_include(
-                        yaml.safe_load(_get_conf_content(cls.base_dir, include))
-                    )
-                )
-            del conf_data["include"]
-            include_data.update(conf_data)
-            conf_data = include_data
-        for attr, hint in typing.get_type_hints(cls).items():
-            if attr in conf_data:
-                tgt_class = None
-                if hasattr(hint, "__origin__") and hint.__origin__ is typing.Union:
-                    for sub_hint in typing.get_args(hint):
-                        if not sub_hint is type(None):
-                            tgt_class = sub_hint
-                            break
-                else:
-                    tgt_class = hint
-                if hasattr(tgt_class, "__origin__"):
-                    # We still have type hint not a class, just punt...
-                    continue
-                if issubclass(tgt_class, IncludableConfig):
-                    conf_data[attr] = tgt_class.from_dict(conf_data[attr])
-                elif issubclass(tgt_class, Config):
-                    conf_data[attr] = tgt_class.from_dict(conf_data[attr])
-                elif issubclass(tgt_class, Enum):
-                    conf_data[attr] = tgt_class(conf_data[attr].lower())
-                elif not isinstance(conf_data[attr], tgt_class):
-                    conf_data[attr] = tgt_class(conf_data[attr])
-        res = cls(**conf_data)
-        res._explicitly_set = set(conf_data.keys())
-        return res
+        include_data.update(conf_data)
+        del include_data["include"]
+        return include_data
 
+    @classmethod
+    def from_dict(cls, conf_data: Dict[str, Any]):
+        if "include" in conf_data:
+            conf_data = cls._resolve_includes(conf_data)
+        return super(IncludableConfig, cls).from_dict(conf_data)
 
-@dataclass
+
+@dataclass(**_DATACLASS_OPTS)
 class SpackBuildChain(Config):
     """Spack build-chain specification"""
 
@@ -251,7 +622,7 @@ class SpackBuildChain(Config):
     binutils: Optional[str] = None
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class SpackConfig(IncludableConfig):
     """Spack specific configuration for an environment"""
 
@@ -263,42 +634,25 @@ class SpackConfig(IncludableConfig):
 
     specs: Optional[List[str]] = None
 
-    def to_dict(self):
-        res = {}
-        for field in fields(self):
-            val = getattr(self, field.name)
-            if val is None:
-                continue
-            if field.name == "build_chains":
-                res[field.name] = [v.to_dict() for v in val]
-            elif hasattr(val, "to_dict"):
-                res[field.name] = val.to_dict()
-            else:
-                res[field.name] = val
-        return res
+    _TO_DICT_HANDLERS = {"build_chains": _config_list_to_dict}
 
-    @classmethod
-    def from_dict(cls, conf_data: Dict[str, Any]):
-        build_chains = conf_data.get("build_chains")
-        if build_chains:
-            conf_data["build_chains"] = [
-                SpackBuildChain.from_dict(x) for x in build_chains
-            ]
-        res = cls(**conf_data)
-        res._explicitly_set = set(conf_data.keys())
-        return res
+    _FROM_DICT_HANDLERS = {
+        "build_chains": partial(_config_list_from_dict, SpackBuildChain)
+    }
 
     def set_defaults(self, defaults: Dict[str, Dict[str, Any]]) -> None:
         build_chains = defaults.get("build_chains")
         if build_chains:
-            defaults = deepcopy(defaults)
-            defaults["build_chains"] = [
-                SpackBuildChain.from_dict(x) for x in build_chains
-            ]
-        super().set_defaults(defaults)
+            defaults = {
+                **defaults,
+                "build_chains": [
+                    SpackBuildChain.from_dict(dict(x)) for x in build_chains
+                ],
+            }
+        super(SpackConfig, self).set_defaults(defaults)
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class PythonConfig(IncludableConfig):
     """Python specific configuration for an environment"""
 
@@ -310,7 +664,7 @@ class PythonConfig(IncludableConfig):
     generate_hashes: bool = False
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class CondaConfig(IncludableConfig):
     """Conda specific configuration for an environment"""
 
@@ -320,18 +674,13 @@ class CondaConfig(IncludableConfig):
 
     @classmethod
     def filt_include(cls, include_data):
-        needs_del = [
-            k for k in include_data if k not in ("channels", "specs", "dependencies")
-        ]
-        for key in needs_del:
-            del include_data[key]
+        res = {k: v for k, v in include_data.items() if k in ("channels", "specs")}
         if "dependencies" in include_data:
-            include_data["specs"] = include_data["dependencies"]
-            del include_data["dependencies"]
-        return include_data
+            res["specs"] = include_data["dependencies"]
+        return res
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class EnvConfig(IncludableConfig):
     """Config for an environment"""
 
@@ -353,7 +702,7 @@ class EnvConfig(IncludableConfig):
                 getattr(self, attr).set_defaults(defaults[attr])
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class CondaAppConfig(IncludableConfig):
     """Config for isolated Conda app"""
 
@@ -370,7 +719,7 @@ class CondaAppConfig(IncludableConfig):
             self.conda.set_defaults(defaults["conda"])
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class PythonAppConfig(IncludableConfig):
     """Config for isolated Python app"""
 
@@ -390,7 +739,7 @@ class PythonAppConfig(IncludableConfig):
                 getattr(self, attr).set_defaults(defaults[attr])
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class SlurmBuildConfig(Config):
     """Config for building on Slurm"""
 
@@ -405,7 +754,7 @@ class SlurmBuildConfig(Config):
     tmp_dir: Optional[Path] = None
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class BuildConfig(Config):
     """Config for building environments / apps"""
 
@@ -416,46 +765,33 @@ class BuildConfig(Config):
 
     slurm_config: Optional[Dict[str, SlurmBuildConfig]] = None
 
-    def to_dict(self):
-        res = {}
-        for field in fields(self):
-            val = getattr(self, field.name)
-            if val is None:
-                continue
-            if field.name == "tmp_dir":
-                res[field.name] = str(val)
-            if field.name == "slurm_config":
-                res[field.name] = {k: v.to_dict() for k, v in val.items()}
-            else:
-                res[field.name] = val
-        return res
+    # If set, buildcache pushes are split into concurrent batches of this many specs
+    push_batch_size: Optional[int] = None
 
-    @classmethod
-    def from_dict(cls, conf_data: Dict[str, Any]):
-        tmp_dir = conf_data.get("tmp_dir")
-        if tmp_dir:
-            conf_data["tmp_dir"] = Path(tmp_dir)
-        slurm_conf = conf_data.get("slurm_config")
-        if slurm_conf:
-            conf_data["slurm_config"] = {
-                name: SlurmBuildConfig.from_dict(sub_conf)
-                for name, sub_conf in slurm_conf.items()
-            }
-        res = cls(**conf_data)
-        res._explicitly_set = set(conf_data.keys())
-        return res
+    _TO_DICT_HANDLERS = {"slurm_config": _config_map_to_dict}
+
+    _FROM_DICT_HANDLERS = {
+        "slurm_config": partial(_config_map_from_dict, SlurmBuildConfig)
+    }
+
+
+# Shared instances used when nothing is configured, these must not be modified
+_DEFAULT_BUILD_CONFIG = BuildConfig()
+
+_DEFAULT_SLURM_BUILD_CONFIG = SlurmBuildConfig()
 
 
 def get_job_build_info(build_config: Optional[BuildConfig], job_type: str):
     if build_config is None:
-        build_config = BuildConfig()
+        build_config = _DEFAULT_BUILD_CONFIG
     if HAS_SLURM:
         if build_config.slurm_config is None:
             slurm_conf = {}
         else:
             slurm_conf = build_config.slurm_config
-        slurm_info = deepcopy(slurm_conf.get(job_type, SlurmBuildConfig()))
-        slurm_info.set_defaults(slurm_conf.get("default", asdict(SlurmBuildConfig())))
+        slurm_info = slurm_conf.get(job_type, _DEFAULT_SLURM_BUILD_CONFIG).clone()
+        slurm_defaults = slurm_conf.get("default", _DEFAULT_SLURM_BUILD_CONFIG)
+        slurm_info.set_defaults(_shallow_dict(slurm_defaults))
         if slurm_info.tasks_per_job is None:
             slurm_info.tasks_per_job = DEFAULT_SLURM_TASKS
         if slurm_info.tmp_dir is None:
@@ -474,7 +810,7 @@ def get_job_build_info(build_config: Optional[BuildConfig], job_type: str):
     }
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class GlobalSpackConfig(Config):
     """Spack config that is handled globally (not per env/app)"""
 
@@ -487,7 +823,7 @@ class GlobalSpackConfig(Config):
     mirrors: Optional[Dict[str, str]] = None
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTS)
 class GlobalCondaConfig(Config):
     """Conda config that is handled globally"""
 
@@ -502,7 +838,19 @@ class GlobalCondaConfig(Config):
             )
 
 
-@dataclass
+def _apps_from_dict(
+    val: Dict[str, Dict[str, Any]]
+) -> Dict[str, Union[CondaAppConfig, PythonAppConfig]]:
+    res = {}
+    for name, app_conf in val.items():
+        if "conda" in app_conf:
+            res[name] = CondaAppConfig.from_dict(app_conf)
+        else:
+            res[name] = PythonAppConfig.from_dict(app_conf)
+    return res
+
+
+@dataclass(**_DATACLASS_OPTS)
 class SiteConfig(Config):
     """Full configuration for a site"""
 
@@ -519,62 +867,32 @@ class SiteConfig(Config):
     envs: Optional[Dict[str, EnvConfig]] = None
 
     def __post_init__(self):
-        app_names = set() if self.apps is None else set(self.apps.keys())
-        env_names = set() if self.envs is None else set(self.envs.keys())
-        for name in app_names | env_names:
-            if not re.match("[a-zA-Z0-9_]+", name):
-                raise InvalidConfigError(f"Invalid env/app name: {name}")
-        collisions = app_names & env_names
+        apps = self.apps or {}
+        envs = self.envs or {}
+        bad_names = [
+            name for name in chain(apps, envs) if not VALID_ENV_APP_NAME.fullmatch(name)
+        ]
+        if bad_names:
+            raise InvalidConfigError(f"Invalid env/app names: {','.join(bad_names)}")
+        if not apps or not envs:
+            return
+        collisions = apps.keys() & envs.keys()
         if collisions:
             raise InvalidConfigError(
                 f"Environments and apps can't share names: {','.join(collisions)}"
             )
 
-    def to_dict(self):
-        res = {}
-        for field in fields(self):
-            val = getattr(self, field.name)
-            if val is None:
-                continue
-            if field.name in ("apps", "envs"):
-                res[field.name] = {k: v.to_dict() for k, v in val.items()}
-            elif field.name != "defaults":
-                res[field.name] = val.to_dict()
-            else:
-                res[field.name] = val
-        return res
+    _TO_DICT_HANDLERS = {"apps": _config_map_to_dict, "envs": _config_map_to_dict}
 
-    @classmethod
-    def from_dict(cls, conf_data: Dict[str, Any]):
-        spack_global = conf_data.get("spack_global")
-        if spack_global:
-            conf_data["spack_global"] = GlobalSpackConfig.from_dict(spack_global)
-        conda_global = conf_data.get("conda_global")
-        if conda_global:
-            conf_data["conda_global"] = GlobalCondaConfig.from_dict(conda_global)
-        build_opts = conf_data.get("build_opts")
-        if build_opts:
-            conf_data["build_opts"] = BuildConfig.from_dict(build_opts)
-        apps = conf_data.get("apps")
-        if apps:
-            converted = {}
-            for name, app_conf in apps.items():
-                if "conda" in app_conf:
-                    converted[name] = CondaAppConfig.from_dict(app_conf)
-                else:
-                    converted[name] = PythonAppConfig.from_dict(app_conf)
-            conf_data["apps"] = converted
-        envs = conf_data.get("envs")
-        if envs:
-            conf_data["envs"] = {
-                name: EnvConfig.from_dict(env_conf) for name, env_conf in envs.items()
-            }
-        res = cls(**conf_data)
-        res._explicitly_set = set(conf_data.keys())
-        return res
+    _FROM_DICT_HANDLERS = {
+        "apps": _apps_from_dict,
+        "envs": partial(_config_map_from_dict, EnvConfig),
+    }
 
     @classmethod
     def build_interactive(cls):
+        import click
+
         spack_repo = click.prompt(
             "Enter the git repo URL for spack",
             default="https://github.com/spack/spack.git",
@@ -584,3 +902,8 @@ class SiteConfig(Config):
             "Enter the git branch to use for spack", default="develop", type=str
         )
         return cls(GlobalSpackConfig(spack_repo, spack_branch))
+
+
+def get_site_conf(conf_path: Path, cache_path: Optional[Path] = None) -> SiteConfig:
+    """Load the site configuration, optionally using a JSON cache of the parsed YAML"""
+    return SiteConfig.from_dict(_load_yaml_cached(conf_path, cache_path))
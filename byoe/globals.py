@@ -4,10 +4,21 @@ from enum import Enum
 from pathlib import Path
 from datetime import datetime
 from dataclasses import dataclass
-from typing import ClassVar, Dict, Any, List, Optional
+from functools import cached_property, lru_cache, total_ordering
+from typing import ClassVar, Dict, Any, List, Optional, Union
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 log = logging.getLogger(__name__)
 
@@ -23,6 +34,10 @@ class EnvType(Enum):
     CONDA = "conda"
 
 
+# Faster than calling `EnvType` when looking up many values
+_ENV_TYPE_BY_NAME = {e.value: e for e in EnvType}
+
+
 LOCK_SUFFIXES = {
     EnvType.SPACK: ".lock",
     EnvType.PYTHON: "-requirements.txt",
@@ -57,6 +72,7 @@ class ShellType(Enum):
 
 
 # TODO: Need some way to track "test" snaps that would have to be explicitly activated
+@total_ordering
 @dataclass(frozen=True)
 class SnapId:
     """Uniquely identify a snaphot"""
@@ -67,6 +83,8 @@ class SnapId:
 
     REGEX: str = r"([0-9]+)(\.[0-9]+)?"
 
+    _PREFIX_RE: ClassVar[re.Pattern] = re.compile(rf"^{REGEX}")
+
     def __repr__(self) -> str:
         if self.version == 0:
             return f"{self.time_stamp.strftime(TS_FORMAT)}"
@@ -75,21 +93,62 @@ class SnapId:
     @classmethod
     def from_str(cls, val: str) -> "SnapId":
         toks = val.split(".")
-        ts = datetime.strptime(toks[0], TS_FORMAT)
+        # Equivalent to `datetime.strptime(toks[0], TS_FORMAT)`, but much faster
+        ts_str = toks[0]
+        if len(ts_str) != 6 or not ts_str.isdigit():
+            raise ValueError(f"Invalid snap id: {val}")
+        ts = datetime(int(ts_str[:4]), int(ts_str[4:]), 1)
         vers = 0 if len(toks) == 1 else int(toks[1])
         return cls(ts, vers)
 
     @classmethod
     def from_prefix(cls, val: str) -> Optional["SnapId"]:
-        mtch = re.search(rf"^{cls.REGEX}", val)
-        if not mtch:
+        mtch = cls._PREFIX_RE.match(val)
+        if not mtch or len(mtch.group(1)) != 6:
+            return None
+        try:
+            return cls.from_str(mtch.group())
+        except ValueError:
             return None
-        return cls.from_str(mtch.group())
-
-    def __lt__(self, other):
-        return (self.time_stamp, self.version) < (other.time_stamp, other.version)
 
+    @cached_property
+    def _sort_key(self):
+        return (self.time_stamp, self.version)
 
+    def __lt__(self, other):
+        return self._sort_key < other._sort_key
+
+
+@lru_cache(maxsize=1024)
+def _get_activate_path(
+    snap_type: SnapType, env_type: EnvType, snap_dir: Path, shell: ShellType
+) -> Path:
+    if snap_type == SnapType.APP or env_type != EnvType.PYTHON:
+        return snap_dir.parent / f"{snap_dir.name}-activate.{shell.value}"
+    if shell == ShellType.SH:
+        suffix = ""
+    else:
+        suffix = f".{shell.value}"
+    return snap_dir / "bin" / f"activate{suffix}"
+
+
+@lru_cache(maxsize=4096)
+def _snap_from_lock_path(cls: type, lock_path: Path) -> "SnapSpec":
+    # Only depends on the path, and the resulting SnapSpec is immutable
+    snap_id = SnapId.from_prefix(lock_path.stem)
+    name_dir = lock_path.parent
+    # Split the rest as a string rather than creating more Path objects
+    base_dir, env_type_name = os.path.split(os.path.dirname(name_dir))
+    env_type = _ENV_TYPE_BY_NAME.get(env_type_name)
+    if env_type is None:
+        env_type = EnvType(env_type_name)
+    snap_type = SnapType.ENV
+    if os.path.basename(base_dir) == "apps":
+        snap_type = SnapType.APP
+    return cls(snap_id, env_type, name_dir.name, name_dir / str(snap_id), snap_type)
+
+
+@total_ordering
 @dataclass(frozen=True)
 class SnapSpec:
     """Capture info about a environment / app snapshot"""
@@ -104,8 +163,12 @@ class SnapSpec:
 
     snap_type: SnapType
 
+    @cached_property
+    def _sort_key(self):
+        return (self.name, self.snap_id._sort_key)
+
     def __lt__(self, other: "SnapSpec"):
-        return (self.name, self.snap_id) < (other.name, other.snap_id)
+        return self._sort_key < other._sort_key
 
     def __str__(self) -> str:
         return f"{self.env_type.name}/{self.snap_name}"
@@ -122,40 +185,52 @@ class SnapSpec:
 
     def get_activate_path(self, shell: ShellType = ShellType.SH) -> Path:
         """Get path to the activation script"""
-        if self.snap_type == SnapType.APP or self.env_type != EnvType.PYTHON:
-            return self.snap_dir.parent / f"{self.snap_dir.name}-activate.{shell.value}"
-        elif self.env_type == EnvType.PYTHON:
-            if shell == ShellType.SH:
-                suffix = ""
-            else:
-                suffix = f".{shell.value}"
-            return self.snap_dir / "bin" / f"activate{suffix}"
+        return _get_activate_path(self.snap_type, self.env_type, self.snap_dir, shell)
 
-    def get_lock_data(self) -> Dict[str, Any]:
+    def get_lock_data(self) -> Union[Dict[str, Any], List[str]]:
         """Get the data from the `lock_file`"""
+        if self.env_type == EnvType.SPACK:
+            # Spack lock files are JSON, which is much faster to parse as such
+            return json_loads(self.lock_file.read_bytes())
+        elif self.env_type == EnvType.CONDA:
+            return yaml.load(self.lock_file.read_bytes(), Loader=SafeLoader)
         txt_data = self.lock_file.read_text()
-        if self.env_type in (EnvType.SPACK, EnvType.CONDA):
-            return yaml.load(txt_data)
-        else:
-            return [l for l in txt_data.split("\n") if not l.strip().startswith("#")]
+        return [l for l in txt_data.split("\n") if not l.strip().startswith("#")]
 
     def get_paths(self) -> List[Path]:
         """Get list of paths associated with the snap"""
-        assoc_files = [self.snap_dir]
+        # Work with plain names in the parent dir, only creating Path objects for
+        # the results. Anything else (e.g. venv activate scripts) is a Path
+        parent = self.snap_dir.parent
+        snap_name = self.snap_dir.name
+        assoc_files: List[Union[str, Path]] = [snap_name]
         for sh_type in ShellType:
-            assoc_files.append(self.get_activate_path(sh_type))
-        assoc_files.append(self.lock_file)
+            act_path = self.get_activate_path(sh_type)
+            assoc_files.append(act_path.name if act_path.parent == parent else act_path)
+        assoc_files.append(f"{snap_name}{LOCK_SUFFIXES[self.env_type]}")
         if self.snap_type == SnapType.ENV:
             if self.env_type == EnvType.SPACK:
-                assoc_files.append(self.snap_dir.parent / f"._{self.snap_id}")
-                assoc_files.append(self.snap_dir.parent / f"{self.snap_id}-env")
+                assoc_files += [f"._{self.snap_id}", f"{self.snap_id}-env"]
             elif self.env_type == EnvType.PYTHON:
-                assoc_files.append(self.snap_dir.parent / f"{self.snap_id}-main-req.in")
-                assoc_files.append(self.snap_dir.parent / f"{self.snap_id}-sys-req.txt")
+                assoc_files += [
+                    f"{self.snap_id}-main-req.in",
+                    f"{self.snap_id}-sys-req.txt",
+                ]
             elif self.env_type == EnvType.CONDA:
-                assoc_files.append(self.snap_dir.parent / f"{self.snap_id}-in.yml")
-        assoc_files = [x for x in assoc_files if x.exists()]
-        return assoc_files
+                assoc_files.append(f"{self.snap_id}-in.yml")
+        # Check most paths against a single directory listing instead of stat calls
+        try:
+            existing = {entry.name for entry in os.scandir(parent)}
+        except FileNotFoundError:
+            return []
+        res = []
+        for path in assoc_files:
+            if isinstance(path, str):
+                if path in existing:
+                    res.append(parent / path)
+            elif path.exists():
+                res.append(path)
+        return res
 
     def remove(self, keep_lock: bool = True) -> None:
         """Remove a snap"""
@@ -170,37 +245,49 @@ class SnapSpec:
                 fp.unlink()
         by_hash = self.snap_dir.parent.parent / ".by_hash"
         if by_hash.exists():
-            for link_path in by_hash.iterdir():
-                if link_path.is_symlink() and link_path.resolve() in assoc_files:
-                    link_path.unlink()
-                    break
+            assoc_strs = {os.path.normpath(fp) for fp in assoc_files}
+            with os.scandir(by_hash) as entries:
+                for entry in entries:
+                    if not entry.is_symlink():
+                        continue
+                    tgt = os.path.join(by_hash, os.readlink(entry.path))
+                    if os.path.normpath(tgt) in assoc_strs:
+                        os.unlink(entry.path)
+                        break
 
     @classmethod
     def from_lock_path(cls, lock_path: Path) -> "SnapSpec":
         """Generate a SnapSpec from the path to its lock file"""
-        snap_id = SnapId.from_prefix(lock_path.stem)
-        name = lock_path.parent.name
-        env_type = EnvType(lock_path.parent.parent.name)
-        snap_type = SnapType.ENV
-        if lock_path.parent.parent.parent.name == "apps":
-            snap_type = SnapType.APP
-        return cls(snap_id, env_type, name, lock_path.parent / str(snap_id), snap_type)
+        return _snap_from_lock_path(cls, lock_path)
 
     @classmethod
     def make_symlinked(
         cls, source: "SnapSpec", name: str, new_id: SnapId
     ) -> "SnapSpec":
         """Create symlinked snap with `new_id` pointing to `source`"""
+        src_dir = source.snap_dir.parent
+        new_dir = src_dir.parent / name
+        # All links share the same relative prefix, so only compute it once
+        rel_dir = os.path.relpath(src_dir, new_dir)
+        src_id, new_id_str = str(source.snap_id), str(new_id)
+        lock_name = source.lock_file.name
         new_lock = None
-        for src_path in source.get_paths():
-            new_path = (
-                src_path.parent.parent
-                / name
-                / src_path.name.replace(str(source.snap_id), str(new_id))
-            )
-            new_path.symlink_to(
-                os.path.relpath(src_path, new_path.parent), src_path.is_dir()
-            )
-            if src_path == source.lock_file:
-                new_lock = new_path
+        created: List[Path] = []
+        try:
+            for src_path in source.get_paths():
+                # Paths inside the snap dir (e.g. venv activate scripts) come with it
+                if src_path.parent != src_dir:
+                    continue
+                new_path = new_dir / src_path.name.replace(src_id, new_id_str)
+                os.symlink(
+                    os.path.normpath(os.path.join(rel_dir, src_path.name)), new_path
+                )
+                created.append(new_path)
+                if src_path.name == lock_name:
+                    new_lock = new_path
+        except OSError:
+            # Don't leave a partial snap behind
+            for new_path in created:
+                new_path.unlink()
+            raise
         return cls.from_lock_path(new_lock)
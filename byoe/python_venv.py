@@ -1,12 +1,21 @@
-import os, logging, shutil
+import os, re, logging, shutil
+from functools import lru_cache
+from hashlib import blake2b
 from pathlib import Path
 from io import TextIOWrapper
-from typing import Dict, List, Optional, Any
+from importlib.metadata import distributions
+from typing import Dict, FrozenSet, List, Optional, Any, Tuple
 
 import sh
 
 from .globals import ShellType, SnapId, SnapSpec
-from .util import get_env_cmd, get_activated_envrion, make_app_act_script, stash_failed
+from .util import (
+    get_env_cmd,
+    get_activated_envrion,
+    get_hash_link_target,
+    make_app_act_script,
+    stash_failed,
+)
 from .conf import PythonConfig
 from .spack import get_spack_env_cmds, unset_implicit_pypath
 
@@ -14,6 +23,134 @@ from .spack import get_spack_env_cmds, unset_implicit_pypath
 log = logging.getLogger(__name__)
 
 
+try:
+    sh.virtualenv
+    HAS_VIRTUALENV = True
+except sh.CommandNotFound:
+    HAS_VIRTUALENV = False
+try:
+    sh.uv
+    HAS_UV = True
+except sh.CommandNotFound:
+    HAS_UV = False
+
+
+@lru_cache(maxsize=128)
+def _activated_env(
+    act_scripts: Tuple[str, ...], base_env: FrozenSet[Tuple[str, str]]
+) -> Dict[str, str]:
+    return get_activated_envrion(list(act_scripts), dict(base_env))
+
+
+def _get_site_dirs(prefix: Path) -> List[str]:
+    return [str(p) for p in prefix.glob("lib/python*/site-packages")]
+
+
+def _freeze_site_dirs(site_dirs: List[str]) -> str:
+    """Produce the same output as 'pip list --format=freeze' for the `site_dirs`"""
+    seen = {}
+    for dist in distributions(path=site_dirs):
+        name = dist.metadata["Name"]
+        if not name:
+            continue
+        key = re.sub(r"[-_.]+", "-", name).lower()
+        if key not in seen:
+            seen[key] = f"{name}=={dist.version}"
+    return "".join(f"{seen[key]}\n" for key in sorted(seen))
+
+
+def _pip_freeze_site_dirs(site_dirs: List[str]) -> Optional[str]:
+    """Produce the same output as 'pip freeze' for the `site_dirs` if possible
+
+    Returns None if any package is editable or was installed from a URL / VCS, as
+    pip's output for those depends on more than the package metadata.
+    """
+    for site_dir in site_dirs:
+        if any(fn.endswith(".egg-link") for fn in os.listdir(site_dir)):
+            return None
+    # Before Python 3.12 pip freeze also skips the packaging tools
+    excludes = {"pip"}
+    py_vers = re.search(r"python(\d+)\.(\d+)", site_dirs[0])
+    if py_vers is None or (int(py_vers[1]), int(py_vers[2])) < (3, 12):
+        excludes.update(("setuptools", "wheel", "distribute"))
+    seen = {}
+    for dist in distributions(path=site_dirs):
+        name = dist.metadata["Name"]
+        if not name:
+            continue
+        key = re.sub(r"[-_.]+", "-", name).lower()
+        if key in seen:
+            continue
+        if dist.read_text("direct_url.json") is not None:
+            return None
+        seen[key] = None if key in excludes else (name.lower(), name, dist.version)
+    lines = sorted(val for val in seen.values() if val is not None)
+    return "".join(f"{name}=={vers}\n" for _, name, vers in lines)
+
+
+# Uses the copy of 'packaging' vendored by pip, as the venv may not have its own
+_PRINT_TAGS = (
+    "from pip._vendor.packaging.tags import sys_tags\n"
+    "print('\\n'.join(str(t) for t in sys_tags()))"
+)
+
+
+def _has_uncached_wheels(
+    lock_path: Optional[Path], wheels_dir: Path, python: sh.Command
+) -> bool:
+    """Check if any pinned requirement in `lock_path` lacks a wheel in `wheels_dir`
+
+    Only wheels with tags supported by `python` are considered.
+    """
+    if lock_path is None or not lock_path.exists():
+        return True
+    try:
+        venv_tags = set(python("-c", _PRINT_TAGS).split())
+    except sh.ErrorReturnCode:
+        log.debug("Unable to get supported wheel tags from: %s", python)
+        return True
+    cached = set()
+    with os.scandir(wheels_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".whl"):
+                continue
+            # Name, version, optional build tag, then the (compressed) tag triple
+            toks = entry.name[:-4].split("-")
+            if len(toks) not in (5, 6):
+                continue
+            py_tags, abi_tags, plat_tags = (t.split(".") for t in toks[-3:])
+            if any(
+                f"{py}-{abi}-{plat}" in venv_tags
+                for py in py_tags
+                for abi in abi_tags
+                for plat in plat_tags
+            ):
+                cached.add((re.sub(r"[-_.]+", "_", toks[0]).lower(), toks[1]))
+    with open(lock_path) as lock_f:
+        for line in lock_f:
+            if not line[:1].isalnum():
+                continue
+            req = line.split(";")[0].split()[0]
+            if "==" not in req:
+                return True
+            name, version = req.split("==", 1)
+            name = re.sub(r"[-_.]+", "_", name.split("[")[0]).lower()
+            if (name, version) not in cached:
+                return True
+    return False
+
+
+def get_venv_env(spack_env: Path, py_venv: Path) -> Dict[str, str]:
+    """Get the environment with the spack env and python venv activated"""
+    act_scripts = (
+        (spack_env.parent / f"{spack_env.name}-activate.sh").read_text(),
+        (py_venv / "bin" / "activate").read_text(),
+    )
+    act_env = _activated_env(act_scripts, frozenset(os.environ.items())).copy()
+    unset_implicit_pypath(spack_env, act_env)
+    return act_env
+
+
 # TODO: Take the 'python' sh.Command that is configured for spack instead of the
 #       'spack_env', then just copy its _env
 def get_venv_cmds(
@@ -23,12 +160,7 @@ def get_venv_cmds(
     log_file: Optional[TextIOWrapper] = None,
 ) -> List[sh.Command]:
     """Get a command inside spack env / python venv"""
-    act_scripts = [
-        (spack_env.parent / f"{spack_env.name}-activate.sh").read_text(),
-        (py_venv / "bin" / "activate").read_text(),
-    ]
-    act_env = get_activated_envrion(act_scripts)
-    unset_implicit_pypath(spack_env, act_env)
+    act_env = get_venv_env(spack_env, py_venv)
     env_bin = py_venv / "bin"
     return [get_env_cmd(env_bin / cmd, act_env, log_file=log_file) for cmd in cmds]
 
@@ -47,6 +179,7 @@ def update_python_env(
     wheels_dir.mkdir(parents=True, exist_ok=True)
     snap_path = locs["envs"] / "python" / env_name / str(snap_id)
     snap_path.parent.mkdir(exist_ok=True, parents=True)
+    by_hash = locs["envs"] / "python" / ".by_hash"
     python = get_spack_env_cmds(spack_snap.snap_dir, ["python"], log_file=log_file)[0]
     kwargs = {}
     sys_pkgs = python_config.system_packages
@@ -57,17 +190,42 @@ def update_python_env(
     build_err: Optional[Exception] = None
     sys_req_path = main_req_path = lock_path = None
     try:
-        python("-m", "venv", snap_path, **kwargs)
+        if HAS_VIRTUALENV:
+            # Seeds pip from its cached wheels, which is faster than 'ensurepip'
+            virtualenv = get_env_cmd(
+                "virtualenv", python._partial_call_args["env"], log_file
+            )
+            virtualenv("--python", str(python), snap_path, **kwargs)
+        else:
+            python("-m", "venv", snap_path, **kwargs)
         pip = get_venv_cmds(spack_snap.snap_dir, snap_path, ["pip"], log_file)[0]
-        pip.install("-U", "pip")
-        pip.install("pip-tools")
-        pip_compile, pip_sync = get_venv_cmds(
-            spack_snap.snap_dir, snap_path, ["pip-compile", "pip-sync"], log_file
-        )
+        env_python = get_venv_cmds(spack_snap.snap_dir, snap_path, ["python"])[0]
+        if HAS_UV:
+            # The uv resolver/installer replaces pip-tools, so don't install it
+            # Source builds (even just for metadata) need the spack compilers /
+            # libraries, as with pip-tools
+            uv = get_env_cmd(
+                "uv", get_venv_env(spack_snap.snap_dir, snap_path), log_file
+            )
+            venv_python = str(snap_path / "bin" / "python")
+        else:
+            if HAS_VIRTUALENV:
+                pip.install("pip-tools")
+            else:
+                pip.install("-U", "pip", "pip-tools")
+            pip_compile, pip_sync = get_venv_cmds(
+                spack_snap.snap_dir, snap_path, ["pip-compile", "pip-sync"], log_file
+            )
         if sys_pkgs:
             sys_req_path = locs["envs"] / "python" / env_name / f"{snap_id}-sys-req.txt"
+            # Read the package metadata directly rather than starting up pip
+            venv_dirs = _get_site_dirs(snap_path)
+            spack_dirs = _get_site_dirs(spack_snap.snap_dir)
             with open(sys_req_path, "wt") as out_f:
-                out_f.write(pip.list(format="freeze"))
+                if venv_dirs and spack_dirs:
+                    out_f.write(_freeze_site_dirs(venv_dirs + spack_dirs))
+                else:
+                    out_f.write(pip.list(format="freeze"))
         main_req_path = locs["envs"] / "python" / env_name / f"{snap_id}-main-req.in"
         with open(main_req_path, "wt") as out_f:
             if sys_req_path:
@@ -75,30 +233,90 @@ def update_python_env(
             for spec in python_config.specs:
                 out_f.write(f"{spec}\n")
         lock_path = locs["envs"] / "python" / env_name / f"{snap_id}-requirements.txt"
-        log.info("Running pip-compile for venv: %s", snap_path)
-        pip_compile(
-            main_req_path,
-            output_file=str(lock_path),
-            generate_hashes=python_config.generate_hashes,
-            allow_unsafe=True,
-            verbose=True,
-        )
-        log.info("Running pip-sync to build venv: %s", snap_path)
-        pip_sync(str(lock_path), pip_args=f"--find-links {wheels_dir}")
+        if HAS_UV:
+            log.info("Running uv pip compile for venv: %s", snap_path)
+            uv.pip.compile(
+                main_req_path,
+                output_file=str(lock_path),
+                python=venv_python,
+                generate_hashes=python_config.generate_hashes,
+                allow_unsafe=True,
+                verbose=True,
+            )
+        else:
+            log.info("Running pip-compile for venv: %s", snap_path)
+            pip_compile(
+                main_req_path,
+                output_file=str(lock_path),
+                generate_hashes=python_config.generate_hashes,
+                allow_unsafe=True,
+                verbose=True,
+            )
+        # Identical spack env and requirements means we can reuse a previous snap
+        snap_hash = blake2b(str(spack_snap.snap_dir.resolve()).encode(), digest_size=20)
+        if sys_req_path:
+            snap_hash.update(sys_req_path.read_bytes())
+        # Skip comments, as pip-compile embeds the (snap specific) file paths in them
+        with open(lock_path, "rb") as lock_f:
+            for line in lock_f:
+                if not line.lstrip().startswith(b"#"):
+                    snap_hash.update(line)
+        hash_link = by_hash / snap_hash.hexdigest()
+        prev_lock = get_hash_link_target(hash_link)
+        if prev_lock is not None:
+            log.info("Found identical python snap, linking to it")
+            shutil.rmtree(snap_path)
+            for path in (sys_req_path, main_req_path, lock_path):
+                if path is not None:
+                    path.unlink()
+            prev_snap = SnapSpec.from_lock_path(prev_lock)
+            # Don't fall through to the wheel building / stashing below, the files
+            # they need were just removed to make way for the links
+            try:
+                return SnapSpec.make_symlinked(prev_snap, env_name, snap_id)
+            except OSError:
+                log.exception("Failed to link to identical python snap: %s", prev_snap)
+                return None
+        if HAS_UV:
+            # Hardlink installed files from uv's cache instead of unpacking every wheel
+            log.info("Running uv pip sync to build venv: %s", snap_path)
+            uv_args = {
+                "python": venv_python,
+                "find_links": str(wheels_dir),
+                "cache_dir": str(wheels_dir / "uv"),
+                "link_mode": "hardlink",
+            }
+            uv.pip.sync(str(lock_path), **uv_args)
+            # Unlike pip-sync, this removes the seeded pip which users (and the wheel
+            # building below) rely on, so put it back
+            uv.pip.install("pip", **uv_args)
+        else:
+            log.info("Running pip-sync to build venv: %s", snap_path)
+            pip_sync(str(lock_path), pip_args=f"--find-links {wheels_dir}")
     except Exception as e:
         build_err = e
         log.exception("Python venv update failed: %s", snap_path)
-    if snap_path.exists():
+    # Each env's pins are often all built already by previous envs
+    if snap_path.exists() and _has_uncached_wheels(lock_path, wheels_dir, env_python):
         log.debug("Updating python wheels dir")
         try:
             pip.wheel(find_links=str(wheels_dir), w=str(wheels_dir), r=str(lock_path))
-        except:
+        except Exception:
             log.exception("Error while building wheels from env: %s", snap_path)
     if build_err is not None:
         stash_failed(sys_req_path, main_req_path, lock_path)
         if snap_path.exists():
             shutil.rmtree(snap_path)
         return None
+    # The snap is already built, so failing to record its hash is not an error. Swap
+    # the link in atomically in case it was left over or created concurrently
+    tmp_link = by_hash / f".{hash_link.name}-{os.getpid()}"
+    try:
+        by_hash.mkdir(exist_ok=True)
+        tmp_link.symlink_to(os.path.relpath(lock_path, hash_link.parent))
+        os.replace(tmp_link, hash_link)
+    except OSError:
+        log.warning("Unable to create hash link: %s", hash_link)
     return SnapSpec.from_lock_path(lock_path)
 
 
@@ -138,11 +356,23 @@ def update_python_app(
     env_dir.symlink_to(
         os.path.relpath(pipx_venv_dir, env_dir.parent), target_is_directory=True
     )
-    act_path = env_dir / "bin" / "activate"
     app_lock_path = locs["apps"] / "python" / app_name / f"{snap_id}-requirements.txt"
     env_lock_path = locs["envs"] / "python" / app_name / f"{snap_id}-requirements.txt"
-    env_python = get_env_cmd("python", get_activated_envrion([act_path.read_text()]))
-    app_lock_path.write_text(env_python("-m", "pip", "freeze"))
+    site_dirs = _get_site_dirs(pipx_venv_dir)
+    lock_data = None
+    if site_dirs and not python_config.system_packages:
+        lock_data = _pip_freeze_site_dirs(site_dirs)
+    if lock_data is None:
+        # Equivalent to sourcing the venv 'activate' script, without spawning a shell
+        act_env = os.environ.copy()
+        act_env["VIRTUAL_ENV"] = str(pipx_venv_dir)
+        act_env["PATH"] = os.pathsep.join(
+            [str(pipx_venv_dir / "bin"), act_env["PATH"]]
+        )
+        act_env.pop("PYTHONHOME", None)
+        env_python = get_env_cmd(pipx_venv_dir / "bin" / "python", act_env)
+        lock_data = env_python("-m", "pip", "freeze")
+    app_lock_path.write_text(lock_data)
     env_lock_path.symlink_to(os.path.relpath(app_lock_path, env_lock_path.parent))
     app_snap = SnapSpec.from_lock_path(app_lock_path)
     # Make app activation scripts
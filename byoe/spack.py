@@ -1,13 +1,12 @@
 """Manage / build spack environments"""
 
 from hashlib import blake2b
-import json
 import os, logging, shutil
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from copy import deepcopy
 from io import TextIOWrapper
-from typing import List, Dict, Optional, Any
+from typing import Callable, List, Dict, Optional, Any
 
 import yaml
 import sh
@@ -15,14 +14,25 @@ import sh
 sh = sh.bake(_tty_out=False)
 git = sh.git
 
-from .globals import SnapId, SnapSpec
-from .util import get_activated_envrion, get_env_cmd, srun_wrap, wrap_cmd
+from .globals import SafeDumper, SafeLoader, SnapId, SnapSpec, json_loads
+from .util import (
+    copy_snap_file,
+    get_activated_envrion,
+    get_env_cmd,
+    get_hash_link_target,
+    srun_wrap,
+    wrap_cmd,
+)
 from .conf import BuildConfig, SpackBuildChain, SpackConfig, get_job_build_info
 
 
 log = logging.getLogger(__name__)
 
 
+# Max number of batched 'spack buildcache push' commands to run at once
+MAX_PUSH_JOBS = 4
+
+
 install_script = """\
 #!/bin/bash
 
@@ -46,8 +56,13 @@ def par_spack(
     cmd: sh.Command,
     args: Optional[List[str]] = None,
     build_info: Optional[Dict[str, Any]] = None,
+    n_concurrent: int = 1,
 ):
-    """Setup spack command to run using multiple CPU cores"""
+    """Setup spack command to run using multiple CPU cores
+
+    If `n_concurrent` copies of the command will run at once, the CPU cores are split
+    between them.
+    """
     if args:
         args = args[:]
     if build_info is None:
@@ -57,8 +72,10 @@ def par_spack(
     # TODO: Would like to be able to overrides this on commnand line
     slurm_cpus = os.environ.get("SLURM_CPUS_ON_NODE")
     if slurm_cpus:
-        args = ["-j", slurm_cpus] + args
-    elif n_tasks:
+        n_tasks = int(slurm_cpus)
+    if n_concurrent > 1:
+        n_tasks = max(1, (n_tasks or os.cpu_count() or 1) // n_concurrent)
+    if n_tasks:
         args = ["-j", str(n_tasks)] + args
     cmd = cmd.bake(*args)
     if build_info["use_slurm"] and not slurm_cpus:
@@ -118,36 +135,69 @@ def get_spack_concretize(
 
 def get_installed(spack: sh.Command) -> List[str]:
     """Get list of installed packages with version and hash"""
-    installed = json.loads(spack.find(json=True))
+    installed = json_loads(spack.find(json=True))
     return [f"{x['name']}@{x['version']}/{x['hash']}" for x in installed]
 
 
 def get_concretized_roots(lock_path: Path) -> List[str]:
-    roots = sorted(json.loads(lock_path.read_text())["roots"], key=lambda x: x["spec"])
+    roots = sorted(json_loads(lock_path.read_bytes())["roots"], key=lambda x: x["spec"])
     return [f"{x['spec']}/{x['hash']}" for x in roots]
 
 
 def get_spack_push(
     spack: sh.Command,
     build_config: Optional[BuildConfig] = None,
-):
-    """Get preconfigured 'spack buildcache push' command"""
+) -> Callable[[], Any]:
+    """Get preconfigured 'spack buildcache push' command
+
+    If the `build_config` sets a `push_batch_size`, the installed specs are pushed
+    in batches that run concurrently, sharing the available CPU cores.
+    """
     if build_config is None:
         build_config = BuildConfig()
-    push_args = ["default"] + get_installed(spack)
-    return par_spack(
-        spack.buildcache.push, push_args, get_job_build_info(build_config, "spack_push")
-    )
-
-
-def get_compilers(spack):
+    build_info = get_job_build_info(build_config, "spack_push")
+    installed = get_installed(spack)
+    batch_size = build_config.push_batch_size
+    if not batch_size or len(installed) <= batch_size:
+        return par_spack(spack.buildcache.push, ["default"] + installed, build_info)
+    batches = [
+        installed[idx : idx + batch_size]
+        for idx in range(0, len(installed), batch_size)
+    ]
+    n_tasks = os.environ.get("SLURM_CPUS_ON_NODE") or build_info["n_tasks"]
+    n_jobs = min(MAX_PUSH_JOBS, len(batches), int(n_tasks or os.cpu_count() or 1))
+    push_cmds = [
+        par_spack(spack.buildcache.push, ["default"] + batch, build_info, n_jobs)
+        for batch in batches
+    ]
+
+    def spack_push() -> None:
+        with ThreadPoolExecutor(n_jobs) as executor:
+            futures = [executor.submit(cmd) for cmd in push_cmds]
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+    return spack_push
+
+
+def get_compilers(spack: sh.Command) -> List[str]:
     """Get compilers spack knows about"""
-    return [x.strip() for x in spack.compiler.list().split("\n")[2:] if x.strip()]
+    # Works across spack versions (compilers may be in the compilers config or be
+    # external packages) with a single spack invocation. Skip the headers and any
+    # status markers, splitting multi-column lines
+    return [
+        tok.replace("@=", "@")
+        for line in spack.compiler.list().split("\n")
+        if not line.startswith(("==>", "--"))
+        for tok in line.split()
+        if "@" in tok
+    ]
 
 
 def _update_compiler_conf(compiler_conf: Path, binutils_path: Path):
     """Update spack compiler config to prepend binutils_path to PATH"""
-    data = yaml.safe_load(compiler_conf.open())
+    data = yaml.load(compiler_conf.read_bytes(), Loader=SafeLoader)
     comp_data = data.get("compilers")
     if comp_data is None:
         comp_data = data["spack"]["compilers"]
@@ -155,7 +205,21 @@ def _update_compiler_conf(compiler_conf: Path, binutils_path: Path):
         comp_env = comp_info["compiler"]["environment"]
         if "prepend_path" not in comp_env:
             comp_env["prepend_path"] = {"PATH": str(binutils_path / "bin")}
-    yaml.dump(data, compiler_conf.open("w"))
+    with compiler_conf.open("w") as out_f:
+        yaml.dump(data, out_f, Dumper=SafeDumper)
+
+
+def _find_install_path(
+    spack: sh.Command, spec: str, cache: Dict[str, Optional[Path]]
+) -> Optional[Path]:
+    """Get install prefix for `spec` (None if not installed), caching the result"""
+    if spec not in cache:
+        # Fails if nothing is installed, so no need to call 'spack find' first
+        try:
+            cache[spec] = Path(spack.location(first=True, i=spec).strip())
+        except sh.ErrorReturnCode:
+            cache[spec] = None
+    return cache[spec]
 
 
 def setup_build_chains(
@@ -168,6 +232,7 @@ def setup_build_chains(
 ) -> None:
     """Configure one or more buildchains, installing any missing pieces as needed"""
     compilers = get_compilers(spack)
+    install_paths = {}
     missing_build_deps = set()
     for bc in buildchains:
         compiler = binutils = None
@@ -178,13 +243,11 @@ def setup_build_chains(
             #       spec "gcc@12" and then match "gcc@12.3.0"). Supporting specs with less-
             #       than or greater-than could be useful.
             if not any(c.startswith(compiler) for c in compilers):
-                try:
-                    spack.find(compiler)
-                except sh.ErrorReturnCode:
+                comp_loc = _find_install_path(spack, compiler, install_paths)
+                if comp_loc is None:
                     missing_build_deps.add(compiler)
                 else:
-                    comp_loc = spack.location(first=True, i=compiler).strip()
-                    spack_comp_find("--scope", conf_scope, comp_loc)
+                    spack_comp_find("--scope", conf_scope, str(comp_loc))
         if bc.binutils is not None:
             binutils = bc.binutils
             if bc.compiler is None:
@@ -200,12 +263,10 @@ def setup_build_chains(
             # TODO: I guess that enabling the assembler here should be an option, not
             #       sure why it's not the default in spack...
             binutils = f"{binutils} +gas"
-            try:
-                spack.find(binutils)
-            except sh.ErrorReturnCode:
+            binutils_path = _find_install_path(spack, binutils, install_paths)
+            if binutils_path is None:
                 missing_build_deps.add(binutils)
             else:
-                binutils_path = Path(spack.location(first=True, i=binutils).strip())
                 _update_compiler_conf(conf_path, binutils_path)
     if missing_build_deps:
         log.info("Installing missing build dependencies: %s", missing_build_deps)
@@ -231,8 +292,9 @@ def _prep_spack_build(
     """Prepare an environment for building"""
     # Initialize the environment config file
     env_dir.mkdir(parents=True)
+    # Only top-level keys get added, so a shallow copy is enough
     if spack_config.config is not None:
-        env_info = deepcopy(spack_config.config)
+        env_info = dict(spack_config.config)
     else:
         env_info = {}
     env_info["specs"] = spack_config.specs[:]
@@ -275,7 +337,7 @@ def _update_spack_env(
     spack: sh.Command,
     spack_install: sh.Command,
     spack_concretize: sh.Command,
-    spack_push: sh.Command,
+    spack_push: Callable[[], Any],
 ) -> None:
     """Create updated snapshot of a single environment and cache any built packages"""
     start = datetime.now()
@@ -283,20 +345,24 @@ def _update_spack_env(
     spack_concretize()
     orig_lock_path = env_dir / "spack.lock"
     canon_lock_path = env_dir.parent / f"{snap_id}.lock"
-    snap_hash = blake2b(
-        (",".join(get_concretized_roots(orig_lock_path))).encode(), digest_size=20
-    )
+    # Same digest as hashing the comma joined roots, without building that string
+    snap_hash = blake2b(digest_size=20)
+    for idx, root in enumerate(get_concretized_roots(orig_lock_path)):
+        if idx != 0:
+            snap_hash.update(b",")
+        snap_hash.update(root.encode())
     hash_link = by_hash / snap_hash.hexdigest()
-    if hash_link.exists():
+    prev_lock = get_hash_link_target(hash_link)
+    if prev_lock is not None:
         # Link to the previous snap
         log.info("Found identical spack snap, linking to it")
         shutil.rmtree(env_dir)
         shutil.rmtree(env_dir.parent / f"._{snap_id}")
         (env_dir.parent / str(snap_id)).unlink()
-        prev_snap = SnapSpec.from_lock_path(hash_link.resolve())
+        prev_snap = SnapSpec.from_lock_path(prev_lock)
         SnapSpec.make_symlinked(prev_snap, name, snap_id)
     else:
-        shutil.copy(orig_lock_path, canon_lock_path)
+        copy_snap_file(orig_lock_path, canon_lock_path)
         hash_link.parent.mkdir(exist_ok=True)
         hash_link.symlink_to(os.path.relpath(canon_lock_path, hash_link.parent))
         log.info("Building spack snapshot: %s", snap_path)
@@ -322,7 +388,7 @@ def _update_spack_env(
             shutil.rmtree(env_dir.parent / f"._{snap_id}")
             if snap_path.exists():
                 snap_path.unlink()
-            if hash_link.exists() and hash_link.resolve() == canon_lock_path:
+            if get_hash_link_target(hash_link) == canon_lock_path:
                 hash_link.unlink()
             raise install_err
         for sh_type in ("sh", "csh", "fish"):
@@ -437,11 +503,12 @@ def get_spack_pkg_cmds(
     log_file: Optional[TextIOWrapper] = None,
 ) -> sh.Command:
     """Get a command from a spack package, installing it if needed"""
+    # Loading fails if the spec isn't installed, so no need for a 'spack find' first
     try:
-        spack.find(spec)
+        act_script = spack.load("--sh", spec)
     except sh.ErrorReturnCode:
         log.info("Installing spack package: %s", spec)
         spack_install([spec])
-    act_script = spack.load("--sh", spec)
+        act_script = spack.load("--sh", spec)
     act_env = get_activated_envrion([act_script], base_env)
     return [get_env_cmd(cmd, act_env, log_file) for cmd in cmds]
@@ -1,10 +1,15 @@
-import os, shlex, json, logging
+import os, sys, shlex, json, logging, shutil
 from datetime import datetime
 from pathlib import Path
 from io import TextIOWrapper
 from difflib import unified_diff
 from typing import List, Dict, Optional, Tuple, Union
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import sh
 
 sh = sh.bake(_tty_out=False)
@@ -21,6 +26,11 @@ except sh.CommandNotFound:
     HAS_SLURM = False
 
 
+# Reflink ioctl from linux/fs.h
+FICLONE = 0x40049409
+HAS_FICLONE = fcntl is not None and sys.platform.startswith("linux")
+
+
 log = logging.getLogger(__name__)
 
 
@@ -150,40 +160,69 @@ def srun_wrap(
     return wrap_cmd(srun.bake(srun_args), cmd, inject_env)
 
 
+_APP_ACT_TEMPLATES = {
+    ShellType.SH: "export PATH={bin}:$PATH\nexport MANPATH={man}:$MANPATH",
+    ShellType.CSH: "setenv PATH {bin}:$PATH\nsetenv MANPATH {man}:$MANPATH",
+    ShellType.FISH: "set -gx PATH {bin}:$PATH\nset -gx MANPATH {man}:$MANPATH",
+}
+
+
 def make_app_act_script(snap_dir: Path, shell_type: ShellType) -> str:
     """Create an activation script for isolate app snapshot"""
-    if shell_type == ShellType.SH:
-        return "\n".join(
-            [
-                f"export PATH={snap_dir / 'bin'}:$PATH",
-                f"export MANPATH={snap_dir / 'man'}:$MANPATH",
-            ]
-        )
-    elif shell_type == ShellType.CSH:
-        return "\n".join(
-            [
-                f"setenv PATH {snap_dir / 'bin'}:$PATH",
-                f"setenv MANPATH {snap_dir / 'man'}:$MANPATH",
-            ]
-        )
-    elif shell_type == ShellType.FISH:
-        return "\n".join(
-            [
-                f"set -gx PATH {snap_dir / 'bin'}:$PATH",
-                f"set -gx MANPATH {snap_dir / 'man'}:$MANPATH",
-            ]
-        )
-    else:
+    template = _APP_ACT_TEMPLATES.get(shell_type)
+    if template is None:
         raise NotImplementedError
+    return template.format(bin=snap_dir / "bin", man=snap_dir / "man")
+
+
+def copy_snap_file(src: Path, dst: Path) -> None:
+    """Copy a file that won't be modified in place, avoiding a real copy if possible
+
+    Tries a hardlink first, then a reflink (on filesystems supporting it) before
+    falling back to a regular copy.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    if HAS_FICLONE:
+        try:
+            with open(src, "rb") as src_f, open(dst, "wb") as dst_f:
+                fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+            shutil.copymode(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy(src, dst)
+
+
+def get_hash_link_target(hash_link: Path) -> Optional[Path]:
+    """Get the lock file a '.by_hash' link points to, removing the link if stale"""
+    try:
+        target = os.readlink(hash_link)
+    except FileNotFoundError:
+        return None
+    # Avoid 'resolve', we only need to undo the relative link not walk every component
+    lock_path = Path(os.path.normpath(hash_link.parent / target))
+    if not lock_path.exists():
+        log.warning("Removing stale hash link: %s", hash_link)
+        hash_link.unlink()
+        return None
+    return lock_path
 
 
 def stash_failed(*orig: Path) -> None:
     """Stash a file from a failed run for debugging purposes"""
+    prefix = f".failed-{str(datetime.now()).replace(' ', '_')}-"
     for o in orig:
-        if o is None or not o.exists():
+        if o is None:
+            continue
+        new = o.parent / f"{prefix}{o.name}"
+        try:
+            o.rename(new)
+        except FileNotFoundError:
             continue
-        new = o.parent / f".failed-{str(datetime.now()).replace(' ', '_')}-{o.name}"
-        o.rename(new)
         log.warning("Stashed file %s -> %s", o, new)
 
 